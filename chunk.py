@@ -3,99 +3,163 @@
 chunk.py - Split large text files into manageable chunks for processing
 """
 
-import json
 import argparse
+import mmap
 import os
 from pathlib import Path
 
+from jsonio import dumps
 
-def chunk_text(text, chunk_size):
-    """Split text into chunks respecting boundaries: newline > period > comma > space > mid-word."""
-    chunks = []
+# Break characters, best first. find_breaks runs one rfind per character and
+# stops at the first hit; a single regex sweep over the window is far slower
+# because it builds a match object for every space and comma it passes.
+BREAK_CHARS = ('\n', '.', ',', ' ')
+
+# New chunk records differ only in index and text, so fill a template
+# rather than building and serializing a dict per chunk
+PENDING_CHUNK = b'{"index":%d,"text":%s,"status":"pending","result":null}'
+
+
+def find_breaks(text, chunk_size):
+    """Yield chunk end offsets respecting boundaries: newline > period > comma > space > mid-word."""
     start = 0
+    text_len = len(text)
+    
+    # Search within a reasonable window (50% of chunk size)
+    window = int(chunk_size * 0.5)
     
-    while start < len(text):
+    while start < text_len:
         # Calculate the ideal end position
         end = start + chunk_size
         
         # If we're at the end of the text, take everything
-        if end >= len(text):
-            chunks.append(text[start:])
+        if end >= text_len:
+            yield text_len
             break
         
         # Look for the best breaking point, searching backwards from the ideal position
         # Priority order: newline > period > comma > space > mid-word
         best_break = end  # Default to mid-word if nothing else found
+        search_start = max(start, end - window)
         
-        # Search within a reasonable window (50% of chunk size)
-        search_start = max(start, end - int(chunk_size * 0.5))
+        # Each window lies past the previous chunk's window, so every character
+        # is scanned at most once per break character: linear in len(text)
+        for char in BREAK_CHARS:
+            pos = text.rfind(char, search_start, end)
+            if pos != -1:
+                best_break = pos + 1
+                break
+        # Otherwise, keep the mid-word break (best_break = end)
         
-        # First, look for newline
-        newline_pos = text.rfind('\n', search_start, end)
-        if newline_pos != -1:
-            best_break = newline_pos + 1
-        else:
-            # Look for period
-            period_pos = text.rfind('.', search_start, end)
-            if period_pos != -1:
-                best_break = period_pos + 1
-            else:
-                # Look for comma
-                comma_pos = text.rfind(',', search_start, end)
-                if comma_pos != -1:
-                    best_break = comma_pos + 1
-                else:
-                    # Look for space
-                    space_pos = text.rfind(' ', search_start, end)
-                    if space_pos != -1:
-                        best_break = space_pos + 1
-                    # Otherwise, keep the mid-word break (best_break = end)
-        
-        # Extract the chunk
-        chunks.append(text[start:best_break])
+        yield best_break
         start = best_break
+
+
+def chunk_text(text, chunk_size):
+    """Yield chunks of text split at the offsets from find_breaks."""
+    start = 0
+    for end in find_breaks(text, chunk_size):
+        yield text[start:end]
+        start = end
+
+
+def chunk_utf8(buf, chunk_size):
+    """Yield the same chunks as chunk_text, decoding a UTF-8 buffer one window at a time.
+
+    Line endings are translated the way a text-mode read would: \\r\\n and a
+    lone \\r both become \\n.
+    """
+    buf_len = len(buf)
+    # Enough bytes for one chunk of ASCII; doubled whenever a window decodes to
+    # too few characters for a full chunk (multi-byte text), never narrowed again
+    window_bytes = chunk_size + 1
+    pos = 0
     
-    return chunks
+    with memoryview(buf) as view:
+        while pos < buf_len:
+            while True:
+                stop = min(pos + window_bytes, buf_len)
+                # Back off so the window doesn't end inside a multi-byte character
+                while stop < buf_len and buf[stop] & 0xC0 == 0x80:
+                    stop -= 1
+                # ...or between the \r and \n of a line ending
+                if stop < buf_len and stop > pos and buf[stop - 1] == 0x0D:
+                    stop -= 1
+                
+                raw = str(view[pos:stop], 'utf-8')
+                window = raw.replace('\r\n', '\n').replace('\r', '\n') if '\r' in raw else raw
+                if len(window) > chunk_size or stop == buf_len:
+                    break
+                window_bytes *= 2
+            
+            end = next(find_breaks(window, chunk_size))
+            yield window[:end]
+            
+            # Each \r\n before the break is one character in the window but two in raw
+            raw_end = end
+            if window is not raw:
+                while True:
+                    next_end = end + raw.count('\r\n', 0, raw_end)
+                    if next_end == raw_end:
+                        break
+                    raw_end = next_end
+                # A break right after a \r\n must take both halves of it
+                if raw[raw_end - 1:raw_end + 1] == '\r\n':
+                    raw_end += 1
+            
+            # Only the short tail past the break is re-encoded to find its byte length
+            pos = stop - len(raw[raw_end:].encode('utf-8'))
+
+
+def chunk_file(input_file, chunk_size):
+    """Yield chunks of a UTF-8 text file without reading the whole file into memory."""
+    with open(input_file, 'rb') as f:
+        # mmap can't map an empty file
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from chunk_utf8(mm, chunk_size)
 
 
 def create_chunked_file(input_file, chunk_size):
     """Create a chunked JSON file from input text file."""
-    # Read input file
-    with open(input_file, 'r', encoding='utf-8') as f:
-        text = f.read()
-    
-    # Create chunks
-    chunks = chunk_text(text, chunk_size)
-    
     # Create output filename
     base_name = Path(input_file).stem
     output_file = f"{base_name}_chunked.json"
     
-    # Create JSON structure
-    data = {
-        "meta": {
-            "book_id": base_name,
-            "chunk_size": chunk_size,
-            "total_chunks": len(chunks)
-        },
-        "chunks": []
-    }
-    
-    # Add chunks to data structure
-    for i, chunk in enumerate(chunks):
-        data["chunks"].append({
-            "index": i,
-            "text": chunk,
-            "status": "pending",
-            "result": None
-        })
-    
-    # Save to JSON file
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # Stream chunks straight to disk instead of building the whole structure in memory.
+    # Chunking and serialization both hold the GIL, so this stays on one thread;
+    # the buffered writes already overlap with the OS flushing to disk.
+    # The temporary file means a failure partway (e.g. invalid UTF-8) never
+    # leaves a truncated file behind or clobbers an existing one.
+    tmp_file = f"{output_file}.tmp"
+    try:
+        with open(tmp_file, 'wb', buffering=1 << 20) as f:
+            f.write(b'{\n  "meta": {\n')
+            f.write(b'    "book_id": ' + dumps(base_name) + b',\n')
+            f.write(b'    "chunk_size": %d,\n' % chunk_size)
+            f.write(b'    "total_chunks": ')
+            total_chunks_pos = f.tell()
+            # Room for the count, filled in once all chunks are written
+            f.write(b' ' * 20 + b'\n  },\n  "chunks": [')
+            
+            total_chunks = 0
+            for i, chunk in enumerate(chunk_file(input_file, chunk_size)):
+                f.write(b',\n    ' if i else b'\n    ')
+                f.write(PENDING_CHUNK % (i, dumps(chunk)))
+                total_chunks = i + 1
+            
+            f.write(b'\n  ]\n}\n' if total_chunks else b']\n}\n')
+            
+            f.seek(total_chunks_pos)
+            f.write(b'%d' % total_chunks)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, output_file)
     
     print(f"✅ Created {output_file}")
-    print(f"📊 Total chunks: {len(chunks)}")
+    print(f"📊 Total chunks: {total_chunks}")
     print(f"📏 Chunk size: {chunk_size} characters")
     
     return output_file
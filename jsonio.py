@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+jsonio.py - JSON helpers shared by chunk.py, process.py and rebuild.py
+
+Uses orjson when it is installed and falls back to the standard json module.
+Chunk files are streamed with ijson when it is installed.
+"""
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# orjson.JSONDecodeError subclasses this, so one except clause covers both
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data):
+    """Parse JSON from bytes or str."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent=False):
+    """Serialize to UTF-8 JSON bytes, keeping non-ASCII text unescaped."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+
+
+def read_json(path):
+    """Load a JSON file."""
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def write_chunked(f, data):
+    """Write a chunked document to a binary file with one compact chunk per line.
+
+    Smaller and quicker to write than fully indented output, while staying
+    readable and diffable line by line.
+    """
+    f.write(b'{')
+    for n, (key, value) in enumerate(data.items()):
+        f.write(b',\n  ' if n else b'\n  ')
+        f.write(dumps(key) + b': ')
+        if key == 'chunks':
+            f.write(b'[')
+            for i, chunk in enumerate(value):
+                f.write(b',\n    ' if i else b'\n    ')
+                f.write(dumps(chunk))
+            f.write(b'\n  ]' if value else b']')
+        else:
+            f.write(dumps(value, indent=True).replace(b'\n', b'\n  '))
+    f.write(b'\n}\n')
+
+
+def write_json(data, path, pretty=False):
+    """Write a chunked JSON file, replacing the old one only once it is complete.
+
+    Chunks are written one per line unless pretty is set, in which case the
+    whole document is indented.
+    """
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'wb', buffering=1 << 20) as f:
+        if pretty:
+            f.write(dumps(data, indent=True))
+        else:
+            write_chunked(f, data)
+    os.replace(tmp_file, path)
+
+
+def iter_chunks(path):
+    """Yield the chunk records of a chunked JSON file one at a time.
+
+    With ijson installed the file is parsed incrementally, so only one chunk
+    is held in memory at a time; otherwise the whole file is loaded first.
+    """
+    if ijson:
+        with open(path, 'rb') as f:
+            yield from ijson.items(f, 'chunks.item')
+    else:
+        yield from read_json(path)['chunks']
@@ -3,19 +3,42 @@
 process.py - Process chunks using LLM with detailed progress tracking
 """
 
-import json
 import argparse
+import asyncio
+import hashlib
 import os
+import random
+import sys
 import time
 from datetime import datetime, timedelta
-from openai import OpenAI
+from pathlib import Path
+from openai import (AsyncOpenAI, OpenAI, APIConnectionError, InternalServerError,
+                    RateLimitError)
 from dotenv import load_dotenv
 
+from jsonio import JSONDecodeError, dumps, loads, read_json, write_json
+
 # Load environment variables
 load_dotenv()
 
+# Batch API limits per input file (50,000 requests, 200 MB), with some headroom on size
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+BATCH_POLL_SECONDS = 60
+
+# Rate limits, timeouts and 5xx responses are retried with jittered exponential backoff
+MAX_ATTEMPTS = 6
+MAX_BACKOFF_SECONDS = 60
+
+# The full JSON file is only rewritten once the sidecar log has grown to this
+# fraction of its size, so total rewrite cost stays linear in the book size
+CHECKPOINT_LOG_RATIO = 0.1
+
 
 class ProgressTracker:
+    # Minimum seconds between progress redraws
+    RENDER_INTERVAL = 0.1
+    
     def __init__(self, total_chunks):
         self.total_chunks = total_chunks
         self.processed = 0
@@ -23,6 +46,7 @@ class ProgressTracker:
         self.failed = 0
         self.start_time = time.time()
         self.failed_chunks = []
+        self._last_render = 0
     
     def update(self, success=True, chunk_index=None):
         self.processed += 1
@@ -33,6 +57,14 @@ class ProgressTracker:
             if chunk_index is not None:
                 self.failed_chunks.append(chunk_index)
     
+    def should_render(self):
+        """Return True at most once per RENDER_INTERVAL, to keep terminal writes cheap."""
+        now = time.monotonic()
+        if now - self._last_render >= self.RENDER_INTERVAL:
+            self._last_render = now
+            return True
+        return False
+    
     def get_speed(self):
         elapsed = time.time() - self.start_time
         if elapsed > 0:
@@ -73,27 +105,328 @@ class ProgressTracker:
         return summary
 
 
-def process_chunk(client, chunk_text, prompt_template, model):
-    """Process a single chunk using the LLM."""
+class AdaptiveLimiter:
+    """Concurrency limit that halves on rate limiting and creeps back up on success (AIMD)."""
+    
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self.generation = 0  # Bumped on every cut, so one burst of 429s cuts only once
+        self._successes = 0
+        self._cond = asyncio.Condition()
+    
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self.generation
+    
+    async def __aexit__(self, *exc_info):
+        async with self._cond:
+            self.active -= 1
+            self._wake()
+    
+    def _wake(self):
+        # Wake only as many waiters as there are free slots; notify_all would
+        # wake every waiter on each release, O(N^2) wakeups for N queued tasks
+        free = self.limit - self.active
+        if free > 0:
+            self._cond.notify(free)
+    
+    def rate_limited(self, generation):
+        if generation == self.generation:
+            self.limit = max(1, self.limit // 2)
+            self.generation += 1
+            self._successes = 0
+    
+    async def succeeded(self, remaining_requests=None):
+        # Grow by one after a full limit's worth of successes, unless the
+        # API says there is no headroom left
+        if remaining_requests is not None and remaining_requests <= self.active:
+            return
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.max_limit:
+            self._successes = 0
+            async with self._cond:
+                self.limit += 1
+                self._wake()
+
+
+def chat_request(chunk_text, prompt_template, model):
+    """Build the chat completion request body for a chunk."""
+    # Replace {text} placeholder in prompt
+    prompt = prompt_template.replace("{text}", chunk_text)
+    
+    return {
+        "model": model,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.3
+    }
+
+
+def prompt_hash(chunk_text, prompt_template, model):
+    """Fingerprint everything that determines a chunk's result."""
+    return hashlib.sha256(f"{model}|{prompt_template}|{chunk_text}".encode('utf-8')).hexdigest()
+
+
+def record_result(chunk, chunk_index, result, error, tracker, chunk_hash):
+    """Store a chunk's result or error and count it in the tracker."""
+    chunk['prompt_hash'] = chunk_hash
+    if result:
+        chunk['status'] = 'done'
+        chunk['result'] = result
+        chunk['error'] = None
+        tracker.update(success=True)
+    else:
+        chunk['status'] = 'error'
+        chunk['error'] = error
+        tracker.update(success=False, chunk_index=chunk_index)
+
+
+def remaining_requests(headers):
+    """Read the remaining request quota from response headers, if it is there and well formed."""
     try:
-        # Replace {text} placeholder in prompt
-        prompt = prompt_template.replace("{text}", chunk_text)
+        return int(headers['x-ratelimit-remaining-requests'])
+    except (KeyError, ValueError):
+        return None
+
+
+async def process_chunk(client, limiter, chunk_text, prompt_template, model):
+    """Process a single chunk using the LLM, retrying transient failures."""
+    for attempt in range(MAX_ATTEMPTS):
+        async with limiter as generation:
+            try:
+                # Call OpenAI API
+                raw = await client.chat.completions.with_raw_response.create(
+                    **chat_request(chunk_text, prompt_template, model)
+                )
+                response = raw.parse()
+                content = response.choices[0].message.content
+            except RateLimitError as e:
+                limiter.rate_limited(generation)
+                error = e
+            except (APIConnectionError, InternalServerError) as e:
+                error = e
+            except Exception as e:
+                return None, str(e)
+            else:
+                await limiter.succeeded(remaining_requests(raw.headers))
+                return content, None
         
-        # Call OpenAI API
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3
+        # Back off outside the limiter so the wait doesn't hold a slot
+        if attempt + 1 < MAX_ATTEMPTS:
+            await asyncio.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, 2 ** attempt)))
+    
+    return None, str(error)
+
+
+async def _process_one(limiter, client, chunk_index, chunk_text, prompt_template, model):
+    """Process one chunk and report which chunk it was."""
+    result, error = await process_chunk(client, limiter, chunk_text, prompt_template, model)
+    return chunk_index, result, error
+
+
+def replay_log(data, log_file):
+    """Merge chunk results recorded in the sidecar log since the last full save."""
+    if not os.path.exists(log_file):
+        return 0
+    
+    replayed = 0
+    with open(log_file, 'rb') as f:
+        for line in f:
+            try:
+                entry = loads(line)
+            except JSONDecodeError:
+                break  # Torn last line from a crash mid-write
+            chunk = data['chunks'][entry['index']]
+            chunk['status'] = entry['status']
+            chunk['result'] = entry['result']
+            chunk['error'] = entry['error']
+            chunk['prompt_hash'] = entry.get('prompt_hash')
+            replayed += 1
+    
+    return replayed
+
+
+async def _process_pending(client, data, json_file, log_file, pending_chunks, tracker,
+                           prompt_template, model, concurrency, save_every, pretty):
+    """Run all pending chunks concurrently, logging each result as it completes."""
+    limiter = AdaptiveLimiter(concurrency)
+    tasks = [
+        _process_one(limiter, client, i, data['chunks'][i]['text'], prompt_template, model)
+        for i in pending_chunks
+    ]
+    
+    with open(log_file, 'ab') as log:
+        pending_writes = 0
+        json_bytes = os.path.getsize(json_file)
+        try:
+            for idx, task in enumerate(asyncio.as_completed(tasks)):
+                chunk_index, result, error = await task
+                chunk = data['chunks'][chunk_index]
+                record_result(chunk, chunk_index, result, error, tracker,
+                              prompt_hash(chunk['text'], prompt_template, model))
+                
+                # Append to the sidecar log so no result is lost on a crash
+                log.write(dumps({
+                    "index": chunk_index,
+                    "status": chunk['status'],
+                    "result": chunk['result'],
+                    "error": chunk['error'],
+                    "prompt_hash": chunk['prompt_hash']
+                }) + b"\n")
+                log.flush()
+                pending_writes += 1
+                
+                # Show progress and a preview of the finished chunk, rate limited
+                # so fast runs aren't held up by terminal writes
+                if tracker.should_render() or idx + 1 == len(pending_chunks):
+                    preview = chunk['text'][:50] + "..." if len(chunk['text']) > 50 else chunk['text']
+                    sys.stdout.write(f"\r{tracker.get_progress_bar(idx + 1, len(pending_chunks))}"
+                                     f"\nCurrent: Finished chunk {chunk_index} - \"{preview}\"\n")
+                    sys.stdout.flush()
+                
+                # Rewrite the full JSON file every save_every chunks, or less often
+                # for large files; until then the log keeps the results safe
+                if pending_writes >= save_every and \
+                        log.tell() >= CHECKPOINT_LOG_RATIO * json_bytes:
+                    write_json(data, json_file, pretty)
+                    json_bytes = os.path.getsize(json_file)
+                    log.seek(0)
+                    log.truncate()
+                    pending_writes = 0
+        finally:
+            if pending_writes:
+                write_json(data, json_file, pretty)
+                log.seek(0)
+                log.truncate()
+    
+    os.remove(log_file)
+
+
+def submit_batches(client, data, json_file, pending_chunks, prompt_template, model):
+    """Upload pending chunks as Batch API jobs and return their batch ids."""
+    # Split into input files that fit the Batch API limits
+    groups = [[]]
+    group_bytes = 0
+    for i in pending_chunks:
+        line = dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": chat_request(data['chunks'][i]['text'], prompt_template, model)
+        }) + b"\n"
+        if groups[-1] and (len(groups[-1]) >= BATCH_MAX_REQUESTS
+                           or group_bytes + len(line) > BATCH_MAX_BYTES):
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(line)
+        group_bytes += len(line)
+    
+    batch_ids = []
+    for n, lines in enumerate(groups):
+        input_file = client.files.create(
+            file=(f"{Path(json_file).stem}_batch{n}.jsonl", b"".join(lines)),
+            purpose="batch"
+        )
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
         )
+        print(f"📤 Submitted batch {batch.id} ({len(lines)} chunks)")
+        batch_ids.append(batch.id)
+    
+    return batch_ids
+
+
+def wait_for_batch(client, batch_id):
+    """Poll a batch until it reaches a final state."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        finished = f"{counts.completed + counts.failed}/{counts.total}" if counts else "?"
+        print(f"\rBatch {batch_id}: {batch.status} | {finished} requests", end='', flush=True)
+        
+        if batch.status in ('completed', 'failed', 'expired', 'cancelled'):
+            print()
+            return batch
+        
+        time.sleep(BATCH_POLL_SECONDS)
+
+
+def collect_batch(client, batch, data, tracker, prompt_template, model):
+    """Merge a finished batch's output and error files into the chunks."""
+    collected = set()
+    
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
         
-        return response.choices[0].message.content, None
-    except Exception as e:
-        return None, str(e)
+        for line in client.files.content(file_id).content.splitlines():
+            if not line:
+                continue
+            entry = loads(line)
+            chunk_index = int(entry['custom_id'])
+            response = entry.get('response')
+            
+            if response and response['status_code'] == 200:
+                result = response['body']['choices'][0]['message']['content']
+                error = None
+            else:
+                result = None
+                error = entry.get('error') or (response or {}).get('body', {}).get('error')
+                if isinstance(error, dict):
+                    error = error.get('message', str(error))
+            
+            chunk = data['chunks'][chunk_index]
+            record_result(chunk, chunk_index, result, error, tracker,
+                          prompt_hash(chunk['text'], prompt_template, model))
+            collected.add(chunk_index)
+    
+    return collected
+
+
+def process_batches(client, data, json_file, pending_chunks, tracker, prompt_template, model,
+                    pretty):
+    """Process pending chunks through the Batch API, resuming batches already submitted."""
+    meta = data['meta']
+    
+    if meta.get('batch_ids'):
+        print(f"Resuming {len(meta['batch_ids'])} submitted batch(es)")
+    else:
+        meta['batch_ids'] = submit_batches(client, data, json_file, pending_chunks,
+                                           prompt_template, model)
+        # Kept so a resumed run hashes the results with what was actually sent
+        meta['batch_prompt'] = prompt_template
+        meta['batch_model'] = model
+        write_json(data, json_file, pretty)
+    
+    print("⏳ Batches can take up to 24h. Safe to Ctrl+C; rerun with --batch to collect results.\n")
+    
+    collected = set()
+    for batch_id in meta['batch_ids']:
+        batch = wait_for_batch(client, batch_id)
+        collected |= collect_batch(client, batch, data, tracker, prompt_template, model)
+    
+    # Chunks left out of the results, e.g. when a batch expired before reaching them
+    for chunk_index in pending_chunks:
+        if chunk_index not in collected:
+            chunk = data['chunks'][chunk_index]
+            record_result(chunk, chunk_index, None, "Not returned by the batch", tracker,
+                          prompt_hash(chunk['text'], prompt_template, model))
+    
+    del meta['batch_ids']
+    meta.pop('batch_prompt', None)
+    meta.pop('batch_model', None)
+    write_json(data, json_file, pretty)
 
 
-def process_chunks(json_file, prompt_template, model):
+def process_chunks(json_file, prompt_template, model, concurrency=16, save_every=25,
+                   batch=False, pretty=False):
     """Process all pending chunks in the JSON file."""
     # Initialize OpenAI client
     api_key = os.getenv('OPENAI_KEY')
@@ -101,27 +434,53 @@ def process_chunks(json_file, prompt_template, model):
         print("❌ Error: OPENAI_KEY not found in .env file")
         return 1
     
-    client = OpenAI(api_key=api_key)
-    
     # Load JSON file
-    with open(json_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    data = read_json(json_file)
+    
+    # Recover results from a run that stopped before its last full save
+    log_file = f"{json_file}.log.jsonl"
+    replayed = replay_log(data, log_file)
+    if replayed:
+        print(f"♻️  Recovered {replayed} results from {log_file}")
+        write_json(data, json_file, pretty)
+    if os.path.exists(log_file):
+        os.remove(log_file)
+    
+    # Outstanding batches are collected under the prompt and model they were
+    # submitted with, so the pending set and result hashes match what was sent
+    meta = data['meta']
+    if batch and meta.get('batch_ids'):
+        batch_prompt = meta.get('batch_prompt', prompt_template)
+        batch_model = meta.get('batch_model', model)
+        if (batch_prompt, batch_model) != (prompt_template, model):
+            print("⚠️  Warning: Outstanding batches used a different prompt or model; "
+                  "collecting them as submitted. Rerun afterwards to apply the new ones.\n")
+        prompt_template, model = batch_prompt, batch_model
     
-    # Count chunks by status
+    # Count chunks by status. A done chunk is redone if the prompt or model
+    # has changed since; chunks from older files without a hash are kept.
     pending_chunks = []
     done_count = 0
+    stale_count = 0
     
     for i, chunk in enumerate(data['chunks']):
-        if chunk['status'] == 'done':
-            done_count += 1
-        else:
+        if chunk['status'] != 'done':
             pending_chunks.append(i)
+        elif chunk.get('prompt_hash') and \
+                chunk['prompt_hash'] != prompt_hash(chunk['text'], prompt_template, model):
+            pending_chunks.append(i)
+            stale_count += 1
+        else:
+            done_count += 1
     
     total_chunks = len(data['chunks'])
     
     print(f"Starting processing of {json_file}")
     print(f"Found {total_chunks} chunks: {len(pending_chunks)} pending, {done_count} already done\n")
     
+    if stale_count:
+        print(f"♻️  {stale_count} done chunks used a different prompt or model and will be redone\n")
+    
     if not pending_chunks:
         print("✅ All chunks already processed!")
         return 0
@@ -130,33 +489,19 @@ def process_chunks(json_file, prompt_template, model):
     tracker = ProgressTracker(total_chunks)
     tracker.success = done_count  # Account for already done chunks
     
-    # Process each pending chunk
-    for idx, chunk_index in enumerate(pending_chunks):
-        chunk = data['chunks'][chunk_index]
-        
-        # Show progress
-        print(f"\r{tracker.get_progress_bar(idx + 1, len(pending_chunks))}", end='', flush=True)
-        
-        # Show current chunk preview
-        preview = chunk['text'][:50] + "..." if len(chunk['text']) > 50 else chunk['text']
-        print(f"\nCurrent: Processing chunk {chunk_index} - \"{preview}\"")
-        
-        # Process the chunk
-        result, error = process_chunk(client, chunk['text'], prompt_template, model)
-        
-        if result:
-            chunk['status'] = 'done'
-            chunk['result'] = result
-            chunk['error'] = None
-            tracker.update(success=True)
-        else:
-            chunk['status'] = 'error'
-            chunk['error'] = error
-            tracker.update(success=False, chunk_index=chunk_index)
+    if batch:
+        # Submit everything to the Batch API and wait for the results
+        client = OpenAI(api_key=api_key)
+        process_batches(client, data, json_file, pending_chunks, tracker, prompt_template, model,
+                        pretty)
+    else:
+        if data['meta'].get('batch_ids'):
+            print("⚠️  Warning: Batches are still outstanding; rerun with --batch to collect them\n")
         
-        # Save after each chunk
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # Process pending chunks concurrently (retries are handled in process_chunk)
+        client = AsyncOpenAI(api_key=api_key, max_retries=0)
+        asyncio.run(_process_pending(client, data, json_file, log_file, pending_chunks, tracker,
+                                     prompt_template, model, concurrency, save_every, pretty))
     
     # Final newline after progress bar
     print()
@@ -174,6 +519,16 @@ def main():
                        help='Prompt template (use {text} as placeholder)')
     parser.add_argument('--model', default='gpt-4o-mini-2024-07-18',
                        help='Model to use (default: gpt-4o-mini-2024-07-18)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                       help='Maximum number of requests in flight; lowered automatically '
+                            'while rate limited (default: 16)')
+    parser.add_argument('--save-every', type=int, default=25,
+                       help='Rewrite the JSON file at most every N chunks (default: 25); '
+                            'large files are rewritten less often')
+    parser.add_argument('--batch', action='store_true',
+                       help='Submit chunks through the OpenAI Batch API (cheaper, finishes within 24h)')
+    parser.add_argument('--pretty', action='store_true',
+                       help='Indent the whole JSON file instead of writing one chunk per line')
     
     args = parser.parse_args()
     
@@ -189,8 +544,17 @@ def main():
         print(f"❌ Error: JSON file '{args.json_file}' not found")
         return 1
     
+    if args.concurrency < 1:
+        print("❌ Error: --concurrency must be at least 1")
+        return 1
+    
+    if args.save_every < 1:
+        print("❌ Error: --save-every must be at least 1")
+        return 1
+    
     # Process chunks
-    return process_chunks(args.json_file, args.prompt, model)
+    return process_chunks(args.json_file, args.prompt, model, args.concurrency, args.save_every,
+                          args.batch, args.pretty)
 
 
 if __name__ == "__main__":
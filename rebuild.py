@@ -3,40 +3,63 @@
 rebuild.py - Rebuild processed chunks into final output file
 """
 
-import json
 import argparse
 import os
 from pathlib import Path
 
+from jsonio import iter_chunks
+
 
 def rebuild_chunks(json_file, output_file=None):
     """Rebuild processed chunks into a final text file."""
-    # Load JSON file
-    with open(json_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
     # If no output file specified, create default name
     if not output_file:
         base_name = Path(json_file).stem.replace('_chunked', '')
         output_file = f"{base_name}_final.txt"
     
-    # Collect statistics
-    total_chunks = len(data['chunks'])
-    done_chunks = []
+    # Stream the chunks once, collecting statistics and writing results as we go
+    total_chunks = 0
+    done_count = 0
     error_chunks = []
     pending_chunks = []
-    
-    for chunk in data['chunks']:
-        if chunk['status'] == 'done':
-            done_chunks.append(chunk)
-        elif chunk['status'] == 'error':
-            error_chunks.append(chunk['index'])
-        else:
-            pending_chunks.append(chunk['index'])
+    last_index = -1
+    in_order = True
+    out = None
+    
+    try:
+        for chunk in iter_chunks(json_file):
+            total_chunks += 1
+            if chunk['index'] <= last_index:
+                in_order = False
+            last_index = chunk['index']
+            
+            if chunk['status'] == 'done':
+                done_count += 1
+                if out is None:
+                    out = open(output_file, 'w', encoding='utf-8', buffering=1 << 20)
+                if in_order and chunk['result']:
+                    out.write(chunk['result'])
+            elif chunk['status'] == 'error':
+                error_chunks.append(chunk['index'])
+            else:
+                pending_chunks.append(chunk['index'])
+    finally:
+        if out is not None:
+            out.close()
+    
+    # chunk.py writes chunks in index order; sort only if the file was edited out of order
+    if not in_order and done_count:
+        done_chunks = [(chunk['index'], chunk['result']) for chunk in iter_chunks(json_file)
+                       if chunk['status'] == 'done']
+        done_chunks.sort(key=lambda x: x[0])
+        with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            for _, result in done_chunks:
+                if result:
+                    f.write(result)
     
     print(f"📊 Chunk Statistics:")
     print(f"- Total chunks: {total_chunks}")
-    print(f"- Completed: {len(done_chunks)}")
+    print(f"- Completed: {done_count}")
     print(f"- Errors: {len(error_chunks)}")
     print(f"- Pending: {len(pending_chunks)}")
     
@@ -46,28 +69,15 @@ def rebuild_chunks(json_file, output_file=None):
     if pending_chunks:
         print(f"\n⚠️  Warning: Found {len(pending_chunks)} pending chunks: {pending_chunks}")
     
-    if not done_chunks:
+    if not done_count:
         print("\n❌ No completed chunks found. Nothing to rebuild.")
         return 1
     
-    # Sort chunks by index to maintain order
-    done_chunks.sort(key=lambda x: x['index'])
-    
-    # Rebuild text from results
-    rebuilt_text = ""
-    for chunk in done_chunks:
-        if chunk['result']:
-            rebuilt_text += chunk['result']
-    
-    # Write to output file
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(rebuilt_text)
-    
     # Calculate file size
     file_size = os.path.getsize(output_file)
     size_kb = file_size / 1024
     
-    print(f"\n✅ Successfully rebuilt {len(done_chunks)} chunks")
+    print(f"\n✅ Successfully rebuilt {done_count} chunks")
     print(f"📄 Output file: {output_file}")
     print(f"📏 File size: {size_kb:.1f} KB ({file_size:,} bytes)")
     